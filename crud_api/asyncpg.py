@@ -1,137 +1,256 @@
-from collections.abc import AsyncIterator, Iterable, Sized
-from functools import cache
+import asyncio
+from collections import Counter
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterable, Iterator
+from functools import lru_cache
+from itertools import chain, islice
 from typing import Any
 
-from asyncpg import Pool
+from asyncpg import Connection, Pool, Record
 from pydantic import BaseModel
+from pydantic.fields import ModelField
+from pydantic.utils import lenient_issubclass
 
-from .base import BaseBulkCrud, BaseCrud, ByEnum, ErrorModel, cached_property
+from .base import BaseBulkCrud, BaseCrud, ByEnum, ErrorModel
+
+
+def _holds_model(field: ModelField) -> bool:
+    return lenient_issubclass(field.type_, BaseModel) or any(_holds_model(f) for f in field.sub_fields or ())
 
 
 class AsyncpgCrud(BaseCrud):
+    # Queries go through asyncpg's per-connection statement cache: every sql below is
+    # built once, so repeated calls reuse the server-side prepared statement. Explicit
+    # `conn.prepare` is not kept around because a PreparedStatement becomes unusable
+    # once its connection is released back to the pool.
     table: str
     pool: Pool
+    # rows come already typed by asyncpg codecs, skip pydantic validation for them;
+    # turn it off when column types do not match the schema types
+    trust_db: bool = True
 
-    def __init__(self, pool: Pool):
-        self.pool = pool
-
-    @cached_property
-    def columns(cls) -> tuple[str, ...]:
-        return tuple(cls.schema.__fields__)
-
-    @cached_property
-    def creatable_columns(cls) -> tuple[str, ...]:
-        return tuple(k for k in cls.schema.__fields__ if k != cls.id_name)
+    # sets of updated fields come from the client, only the most recent ones keep their sql
+    update_cache_size: int = 256
 
-    @cached_property
-    def columns_str(cls) -> str:
-        return ",".join(cls.columns)
+    create_sql: str
+    read_sql: str
+    update_sql: str
+    delete_sql: str
 
-    @cached_property
-    def create_sql(cls):
-        return """
-            insert into {}({}) values ({}) returning *
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if getattr(cls, "schema", None) is None or getattr(cls, "table", None) is None:
+            return
+        cls.create_sql = """
+            insert into {}({}) values ({}) returning {}
         """.format(
             cls.table,
             ",".join(cls.creatable_columns),
             ",".join(f"${i+1}" for i in range(len(cls.creatable_columns))),
+            cls.columns_str,
         )
-
-    async def create(self, **fields) -> BaseModel:
-        async with self.pool.acquire() as conn:
-            data = await conn.fetchrow(self.create_sql, *(fields[k] for k in self.creatable_columns))
-        return self.schema(**data)
-
-    @cached_property
-    def read_sql(cls):
-        return """
-            select * from {} where {} = $1
+        cls.read_sql = """
+            select {} from {} where {} = $1
+        """.format(
+            cls.columns_str,
+            cls.table,
+            cls.id_name,
+        )
+        cls.update_sql = """
+            update {} set {{}} where {} = $1 returning {}
+        """.format(
+            cls.table,
+            cls.id_name,
+            cls.columns_str,
+        )
+        cls.delete_sql = """
+            delete from {} where {} = $1 returning {}
         """.format(
             cls.table,
             cls.id_name,
+            cls.columns_str,
         )
 
-    async def read(self, pk: Any) -> BaseModel | None:
+    def __init__(self, pool: Pool):
+        self.pool = pool
+        self._update_statement_cache = lru_cache(maxsize=self.update_cache_size)(self._build_update_statement)
+
+    def _to_schema(self, record: Record) -> BaseModel:
+        if self.trust_db:
+            # only schema columns, a record from custom sql may carry more
+            return self.schema.construct(**{k: record[k] for k in self.columns})
+        return self.schema(**record)
+
+    async def _create(self, conn: Connection, **fields) -> BaseModel:
+        data = await conn.fetchrow(self.create_sql, *(fields[k] for k in self.creatable_columns))
+        return self._to_schema(data)
+
+    async def create(self, **fields) -> BaseModel:
         async with self.pool.acquire() as conn:
-            data = await conn.fetchrow(self.read_sql, pk)
+            return await self._create(conn, **fields)
+
+    async def _read(self, conn: Connection, pk: Any) -> BaseModel | None:
+        data = await conn.fetchrow(self.read_sql, pk)
         if not data:
             return None
-        return self.schema(**data)
+        return self._to_schema(data)
 
-    @cached_property
-    def update_sql(cls):
-        return """
-            update {} set {{}} where {} = $1 returning *
-        """.format(
-            cls.table,
-            cls.id_name,
-        )
+    async def read(self, pk: Any) -> BaseModel | None:
+        async with self.pool.acquire() as conn:
+            return await self._read(conn, pk)
 
-    async def update(self, pk: Any, **fields) -> BaseModel | None:
-        keys = [k for k in fields if k in self.creatable_columns]
+    def _build_update_statement(self, keys: frozenset[str]) -> tuple[str, tuple[str, ...]]:
         if len(keys) == 0:
             raise ValueError("No fields for update")
-        set_sql = ",".join(f"{keys[i]} = ${i+2}" for i in range(len(keys)))
-        sql = self.update_sql.format(set_sql)
-        async with self.pool.acquire() as conn:
-            data = await conn.fetchrow(sql, pk, *(fields[keys[i]] for i in range(len(keys))))
+        # columns order is fixed, so the same set of fields always gives the same sql
+        ordered_keys = tuple(k for k in self.creatable_columns if k in keys)
+        set_sql = ",".join(f"{k} = ${i+2}" for i, k in enumerate(ordered_keys))
+        return self.update_sql.format(set_sql), ordered_keys
+
+    def _update_statement(self, fields: Iterable[str]) -> tuple[str, tuple[str, ...]]:
+        return self._update_statement_cache(frozenset(k for k in fields if k in self.creatable_columns))
+
+    async def _update(self, conn: Connection, pk: Any, **fields) -> BaseModel | None:
+        sql, keys = self._update_statement(fields)
+        data = await conn.fetchrow(sql, pk, *(fields[k] for k in keys))
         if not data:
             return None
-        return self.schema(**data)
+        return self._to_schema(data)
 
-    @cached_property
-    def delete_sql(cls):
-        return """
-            delete from {} where {} = $1 returning *
-        """.format(
-            cls.table,
-            cls.id_name,
-        )
-
-    async def delete(self, pk: Any) -> BaseModel | None:
+    async def update(self, pk: Any, **fields) -> BaseModel | None:
         async with self.pool.acquire() as conn:
-            data = await conn.fetchrow(self.delete_sql, pk)
+            return await self._update(conn, pk, **fields)
+
+    async def _delete(self, conn: Connection, pk: Any) -> BaseModel | None:
+        data = await conn.fetchrow(self.delete_sql, pk)
         if not data:
             return None
-        return self.schema(**data)
+        return self._to_schema(data)
+
+    async def delete(self, pk: Any) -> BaseModel | None:
+        async with self.pool.acquire() as conn:
+            return await self._delete(conn, pk)
 
 
 class AsyncpgBulkCrud(AsyncpgCrud, BaseBulkCrud):
+    bulk_batch_size: int = 1000
+    # connections used by bulk_update and bulk_delete, defaults to the pool max size
+    bulk_concurrency: int | None = None
+    # rows pulled from the read_many cursor per round trip, tune it to the row width
+    fetch_size: int = 256
+    # postgres protocol limit for bind parameters in one statement
+    max_query_args = 32767
+    read_many_cache_size: int = 256
+
+    def __init__(self, pool: Pool):
+        super().__init__(pool)
+        self._read_many_statement = lru_cache(maxsize=self.read_many_cache_size)(self._read_many_sql)
+
+    def _batches(self, data: Iterable) -> Iterator[list]:
+        size = max(1, min(self.bulk_batch_size, self.max_query_args // max(1, len(self.creatable_columns))))
+        it = iter(data)
+        while batch := list(islice(it, size)):
+            yield batch
+
+    def _bulk_create_sql(self, rows: int) -> str:
+        size = len(self.creatable_columns)
+        values = ",".join("({})".format(",".join(f"${row * size + i + 1}" for i in range(size))) for row in range(rows))
+        return (
+            f"insert into {self.table}({','.join(self.creatable_columns)}) values {values} returning {self.columns_str}"
+        )
+
     async def bulk_create(
-        self, data: Iterable[dict], only_errors: bool = True
+        self, data: Iterable[BaseModel], only_errors: bool = True
     ) -> AsyncIterator[BaseModel | ErrorModel]:
-        for obj in data:
-            try:
-                _obj = await self.create(**obj)
-                if not only_errors:
-                    yield _obj
-            except Exception as e:
-                yield ErrorModel(obj=obj, error=str(e))
+        creatable = self.creatable_columns
+        async with self.pool.acquire() as conn:
+            for batch in self._batches(data):
+                try:
+                    if self._nested_fields:
+                        records = [tuple(d[k] for k in creatable) for d in (obj.dict() for obj in batch)]
+                    else:
+                        # objects are validated already, take positional values without building dicts
+                        records = [tuple(getattr(obj, k) for k in creatable) for obj in batch]
+                    if only_errors:
+                        await conn.copy_records_to_table(self.table, records=records, columns=creatable)
+                        rows = []
+                    else:
+                        rows = await conn.fetch(self._bulk_create_sql(len(records)), *chain.from_iterable(records))
+                except Exception:
+                    # the whole batch was rolled back, retry it row by row to report failed objects
+                    for obj in batch:
+                        fields = obj.dict()
+                        try:
+                            _obj = await self._create(conn, **fields)
+                            if not only_errors:
+                                yield _obj
+                        except Exception as e:
+                            yield ErrorModel(obj=fields, error=str(e))
+                    continue
 
+                for row in rows:
+                    yield self._to_schema(row)
+
+    # sql condition per filter, "in" takes one array argument so the statement shape is fixed
     filter_operator = {
-        "eq": "=",
-        "in": "in",
-        "lte": "<=",
-        "lt": "<",
-        "gt": ">",
-        "gte": ">=",
+        "eq": "{column} = {arg}",
+        "in": "{column} = any({arg})",
+        "lte": "{column} <= {arg}",
+        "lt": "{column} < {arg}",
+        "gt": "{column} > {arg}",
+        "gte": "{column} >= {arg}",
     }
+    # filter name -> (column, sql condition), columns may contain "_" so names are never split
+    _filter_lookup: dict[str, tuple[str, str]] = {}
+    # some creatable field holds pydantic models, codecs take them only as dicts from obj.dict()
+    _nested_fields: bool = False
 
-    def _configure_filters_sql(
-        self,
-        filters: dict[str, Any],
-    ):
-        arguments = []
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if getattr(cls, "schema", None) is None:
+            return
+        cls._filter_lookup = {
+            f"{column}_{f}": (column, operator) for column in cls.columns for f, operator in cls.filter_operator.items()
+        }
+        cls._nested_fields = any(_holds_model(cls.schema.__fields__[k]) for k in cls.creatable_columns)
+
+    def _configure_filters_sql(self, filters: Iterable[str]) -> list[str]:
         filters_sql = []
 
-        if filters is not None:
-            for f in filters:
-                field, _filter = f.split("_")
-                operator = self.filter_operator[_filter]
-                arguments.append(filters[f])
-                filters_sql.append(f"{field} {operator} ${len(arguments)}")
+        for i, f in enumerate(filters, 1):
+            field, operator = self._filter_lookup[f]
+            filters_sql.append(operator.format(column=field, arg=f"${i}"))
+
+        return filters_sql
+
+    def _read_many_sql(
+        self,
+        filters: tuple[str, ...],
+        limit: bool,
+        offset: bool,
+        order_by: tuple[tuple[str, ByEnum], ...],
+    ) -> str:
+        # bind arguments go in the filters order, then limit and offset
+        sql = f"select {self.columns_str} from {self.table}"
+
+        filters_sql = self._configure_filters_sql(filters)
+        args = len(filters_sql)
+
+        if args > 0:
+            sql = f"{sql} where {' and '.join(filters_sql)}"
+
+        if order_by:
+            order_by_str = ",".join(f"{k} {sort.value}" for k, sort in order_by)
+            sql = f"{sql} order by {order_by_str}"
 
-        return filters_sql, arguments
+        if limit:
+            args += 1
+            sql = f"{sql} limit ${args}"
+
+        if offset:
+            args += 1
+            sql = f"{sql} offset ${args}"
+
+        return sql
 
     async def _read_many(
         self,
@@ -140,62 +259,143 @@ class AsyncpgBulkCrud(AsyncpgCrud, BaseBulkCrud):
         order_by: dict[str, ByEnum] | None = None,
         **filters,
     ) -> AsyncIterator[BaseModel]:
-        sql = f"select * from {self.table}"
-
-        filters_sql, arguments = self._configure_filters_sql(filters)
-
-        if len(filters_sql) > 0:
-            sql = f"{sql} where {' and '.join(filters_sql)}"
-
+        # filters in a fixed order, so one sql serves every request with the same query shape
+        names = []
+        arguments = []
+        for name, value in sorted(filters.items()):
+            names.append(name)
+            arguments.append(value)
         if limit is not None:
             arguments.append(limit)
-            sql = f"{sql} limit ${len(arguments)}"
-
         if offset is not None:
             arguments.append(offset)
-            sql = f"{sql} offset ${len(arguments)}"
-
-        if order_by is not None:
-            order_by_str = ",".join(
-                f"{k} {sort}"
-                for k, sort in map(
-                    lambda k, v: (k, v.value),  # type: ignore
-                    order_by.items(),
-                )
-            )
-            sql = f"{sql} order by {order_by_str}"
+        sql = self._read_many_statement(
+            tuple(names), limit is not None, offset is not None, tuple(order_by.items()) if order_by else ()
+        )
 
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                if len(arguments) > 0:
-                    cursor = conn.cursor(sql, *arguments)
-                else:
-                    cursor = conn.cursor(sql)
-                async for record in cursor:
-                    yield self.schema(**record)
+                cursor = await conn.cursor(sql, *arguments)
+                while records := await cursor.fetch(self.fetch_size):
+                    for record in records:
+                        yield self._to_schema(record)
+
+    async def _fan_out(
+        self,
+        items: Iterable,
+        handler: Callable[[Connection, Any], Awaitable[BaseModel | ErrorModel | None]],
+        key: Callable[[Any], Any],
+    ) -> AsyncIterator[BaseModel | ErrorModel | None]:
+        # every worker holds one connection and pulls groups from the shared iterator,
+        # so round trips overlap across connections; results come in completion order.
+        # items with the same key (pk) form one group and run in input order on one connection
+        groups: dict[Any, list] = {}
+        for item in items:
+            groups.setdefault(key(item), []).append(item)
+        if not groups:
+            return
+
+        it = iter(groups.values())
+        concurrency = min(self.bulk_concurrency or self.pool.get_max_size(), len(groups))
+        # bounded, workers wait for the consumer instead of buffering every result
+        results: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+        done = object()
+
+        async def worker():
+            try:
+                async with self.pool.acquire() as conn:
+                    for group in it:
+                        for item in group:
+                            await results.put(await handler(conn, item))
+            except Exception:
+                await results.put(done)
+                raise
+            else:
+                # no marker when cancelled: the consumer is gone and the queue may stay full
+                await results.put(done)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            running = len(workers)
+            while running:
+                result = await results.get()
+                if result is done:
+                    running -= 1
+                    continue
+                yield result
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def _bulk_update_one(self, conn: Connection, obj: dict) -> BaseModel | ErrorModel | None:
+        try:
+            if self.id_name not in obj:
+                raise ValueError(f"{self.id_name} not in object")
+            return await self._update(conn, obj[self.id_name], **obj)
+        except Exception as e:
+            return ErrorModel(obj=obj, error=str(e))
 
     async def bulk_update(
         self, data: Iterable[dict], only_errors: bool = True
     ) -> AsyncIterator[BaseModel | ErrorModel]:
-        for obj in data:
-            try:
-                if self.id_name not in obj:
-                    raise ValueError(f"{self.id_name} not in object")
-                _obj = await self.update(obj[self.id_name], **obj)
-                if not only_errors and _obj:
-                    yield _obj
-            except Exception as e:
-                yield ErrorModel(obj=obj, error=str(e))
+        if only_errors:
+            # updated rows are not returned, objects with the same fields share one executemany.
+            # a pk repeated in the input goes the per-object way, which keeps its updates in input order
+            data = list(data)
+            pks = Counter(obj.get(self.id_name) for obj in data)
+            partitions: dict[frozenset[str], list[dict]] = {}
+            for obj in data:
+                keys: frozenset[str] = frozenset()
+                if self.id_name in obj and pks[obj[self.id_name]] == 1:
+                    keys = frozenset(k for k in obj if k in self.creatable_columns)
+                partitions.setdefault(keys, []).append(obj)
+
+            data = []
+            batches = {}
+            for keys, objs in partitions.items():
+                if len(keys) == 0 or len(objs) == 1:
+                    data.extend(objs)
+                else:
+                    batches[keys] = objs
+
+            if batches:
+                async with self.pool.acquire() as conn:
+                    for keys, objs in batches.items():
+                        sql, ordered_keys = self._update_statement(keys)
+                        try:
+                            await conn.executemany(
+                                sql, [(obj[self.id_name], *(obj[k] for k in ordered_keys)) for obj in objs]
+                            )
+                        except Exception:
+                            # executemany is atomic, update the objects one by one to report failed ones
+                            data.extend(objs)
+
+        async for _obj in self._fan_out(data, self._bulk_update_one, key=lambda obj: obj.get(self.id_name)):
+            if isinstance(_obj, ErrorModel) or (not only_errors and _obj):
+                yield _obj
+
+    async def _bulk_delete_one(self, conn: Connection, pk: Any) -> BaseModel | ErrorModel | None:
+        try:
+            return await self._delete(conn, pk)
+        except Exception as e:
+            return ErrorModel(obj={"pk": pk}, error=str(e))
 
     async def bulk_delete(
         self,
         pks: Iterable[Any],
         only_errors: bool = True,
     ) -> AsyncIterator[BaseModel | ErrorModel]:
-        for pk in pks:
-            try:
-                obj = await self.delete(pk)
-                if not only_errors and obj:
-                    yield obj
-            except Exception as e:
-                yield ErrorModel(obj={"pk": pk}, error=str(e))
+        if only_errors:
+            pks = list(pks)
+            if len(pks) > 1:
+                async with self.pool.acquire() as conn:
+                    try:
+                        await conn.executemany(self.delete_sql, [(pk,) for pk in pks])
+                        return
+                    except Exception:
+                        pass
+
+        async for obj in self._fan_out(pks, self._bulk_delete_one, key=lambda pk: pk):
+            if isinstance(obj, ErrorModel) or (not only_errors and obj):
+                yield obj
@@ -4,25 +4,57 @@ import enum
 from abc import abstractmethod
 from collections.abc import AsyncIterator, Iterable, Sized
 from decimal import Decimal
-from functools import cache
 from typing import Any
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, create_model, validator
 from pydantic.fields import ModelField
 
 
-def cached_property(f):
-    return classmethod(property(cache(f)))
-
-
 class ByEnum(enum.Enum):
     asc = "asc"
     desc = "desc"
 
 
+def _set_columns(cls) -> None:
+    if cls.id_name not in cls.schema.__fields__:
+        raise ValueError(f"{cls.__name__}: schema {cls.schema.__name__} has no {cls.id_name!r} field, set id_name")
+    cls.columns = tuple(cls.schema.__fields__)
+    cls.creatable_columns = tuple(k for k in cls.schema.__fields__ if k != cls.id_name)
+    cls.columns_str = ",".join(cls.columns)
+
+
+def _derive_schema(
+    schema: type[BaseModel], name: str, exclude: tuple[str, ...] = (), optional: bool = False
+) -> type[BaseModel]:
+    # fields of the new model are copies made by pydantic, changing them leaves the base schema intact
+    derived = create_model(name, __base__=schema)
+    for k in exclude:
+        del derived.__fields__[k]
+    if optional:
+        for field in derived.__fields__.values():
+            field.required = False
+    return derived
+
+
 class BaseCrud(abc.ABC):
     schema: type[BaseModel]
     id_name: str = "id"
+    columns: tuple[str, ...]
+    creatable_columns: tuple[str, ...]
+    columns_str: str
+    _create_schema: type[BaseModel]
+    _patch_schema: type[BaseModel]
+    _put_schema: type[BaseModel]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # a bulk crud built on a crud sets its columns and schemas in BaseBulkCrud
+        if getattr(cls, "schema", None) is not None and not issubclass(cls, BaseBulkCrud):
+            _set_columns(cls)
+            name = cls.schema.__name__
+            cls._create_schema = _derive_schema(cls.schema, f"Create{name}", exclude=(cls.id_name,))
+            cls._patch_schema = _derive_schema(cls.schema, f"PartUpdate{name}", exclude=(cls.id_name,), optional=True)
+            cls._put_schema = _derive_schema(cls.schema, f"FullUpdate{name}", exclude=(cls.id_name,))
 
     @abstractmethod
     async def create(self, **fields) -> BaseModel:
@@ -49,10 +81,29 @@ class ErrorModel(BaseModel):
 class BaseBulkCrud(abc.ABC):
     schema: type[BaseModel]
     id_name: str = "id"
+    columns: tuple[str, ...]
+    creatable_columns: tuple[str, ...]
+    columns_str: str
+    available_filters: dict[str, type]
+    _bulk_create_schema: type[BaseModel]
+    _bulk_update_schema: type[BaseModel]
+    _bulk_delete_schema: type[BaseModel]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if getattr(cls, "schema", None) is not None:
+            _set_columns(cls)
+            cls.available_filters = cls._build_available_filters()
+            name = cls.schema.__name__
+            cls._bulk_create_schema = _derive_schema(cls.schema, f"BulkCreate{name}", exclude=(cls.id_name,))
+            cls._bulk_update_schema = _derive_schema(cls.schema, f"BulkPartUpdate{name}", optional=True)
+            cls._bulk_delete_schema = create_model(
+                f"BulkDelete{name}", **{cls.id_name: (cls.schema.__fields__[cls.id_name].type_, ...)}
+            )
 
     @abstractmethod
     async def bulk_create(
-        self, data: Iterable[dict], only_errors: bool = True
+        self, data: Iterable[BaseModel], only_errors: bool = True
     ) -> AsyncIterator[BaseModel | ErrorModel]:
         yield ErrorModel(obj={}, error="unimplement")
 
@@ -62,8 +113,8 @@ class BaseBulkCrud(abc.ABC):
     for _t in (int, float, datetime.date, datetime.datetime, datetime.timedelta, datetime.time, Decimal):
         specific_type_mapping[_t] = _other_filters
 
-    @cached_property
-    def available_filters(cls) -> dict[str, type]:
+    @classmethod
+    def _build_available_filters(cls) -> dict[str, type]:
         _filters = {}
         val: ModelField
         for val in cls.schema.__fields__.values():
@@ -79,7 +130,7 @@ class BaseBulkCrud(abc.ABC):
                 if spec:
                     _t = val.type_
                 if f == "in":
-                    _t = tuple[_t]
+                    _t = tuple[_t, ...]
                 _filters[f"{val.name}_{f}"] = _t
 
         return _filters
@@ -99,7 +150,7 @@ class BaseBulkCrud(abc.ABC):
         self,
         limit: int | None = None,
         offset: int | None = None,
-        order_by: dict[str, int] | None = None,
+        order_by: dict[str, ByEnum] | None = None,
         **filters,
     ) -> AsyncIterator[BaseModel]:
         if len(filters) > 0:
@@ -1,9 +1,12 @@
 import enum
-from collections.abc import Callable
+from collections.abc import AsyncIterator, Callable
+from functools import cache
 from inspect import Parameter, signature
+from typing import Any, get_args
 
 from fastapi import APIRouter, Body, Depends, HTTPException, params
 from fastapi.exceptions import RequestErrorModel
+from fastapi.openapi.constants import REF_PREFIX
 from fastapi.params import Query
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, create_model
@@ -15,6 +18,58 @@ RESPONSES = {
 }
 
 
+class NDJSONResponse(StreamingResponse):
+    media_type = "application/x-ndjson"
+
+
+async def ndjson(objs: AsyncIterator[BaseModel]) -> AsyncIterator[bytes]:
+    async for obj in objs:
+        yield obj.json().encode() + b"\n"
+
+
+async def _prepend(first: BaseModel, objs: AsyncIterator[BaseModel]) -> AsyncIterator[BaseModel]:
+    yield first
+    async for obj in objs:
+        yield obj
+
+
+async def ndjson_response(objs: AsyncIterator[BaseModel], status_code: int = 200) -> NDJSONResponse:
+    # the first object is taken before the status is sent, so a query that fails to start
+    # still ends in a 5xx; errors after that can only cut the stream short
+    try:
+        first = await anext(objs)
+    except StopAsyncIteration:
+        return NDJSONResponse(iter(()), status_code=status_code)
+    return NDJSONResponse(ndjson(_prepend(first, objs)), status_code=status_code)
+
+
+def ndjson_route(model: Any, status_code: int = 200) -> dict[str, Any]:
+    # routes return NDJSONResponse themselves, response_model only brings the line models into
+    # the openapi components. The route class has no media type, otherwise fastapi documents
+    # the body as a plain string next to the declared schema
+    refs: list[dict[str, Any]] = [{"$ref": f"{REF_PREFIX}{m.__name__}"} for m in get_args(model) or (model,)]
+    schema: dict[str, Any] = refs[0] if len(refs) == 1 else {"anyOf": refs}
+    return {
+        "status_code": status_code,
+        "response_model": model,
+        "response_class": StreamingResponse,
+        "responses": {status_code: {"content": {NDJSONResponse.media_type: {"schema": schema}}}},
+    }
+
+
+def filter_parameters(available_filters: dict[str, type]) -> tuple[Parameter, ...]:
+    return tuple(
+        Parameter(_f, Parameter.KEYWORD_ONLY, default=Query(None), annotation=_t)
+        for _f, _t in available_filters.items()
+    )
+
+
+@cache
+def crud_filter_parameters(crud_model: type[BaseBulkCrud]) -> tuple[Parameter, ...]:
+    # built once per crud class, every router over the same crud reuses them
+    return filter_parameters(crud_model.available_filters)
+
+
 class BaseCRUDRouter(APIRouter):
     crud_model: type[BaseCrud]
     crud_model_dependence: Callable[..., BaseCrud]
@@ -46,6 +101,12 @@ class BaseCRUDRouter(APIRouter):
     def schema(self):
         return self.crud_model.schema
 
+    def crud_schema(self, schema: type[BaseModel], prefix: str) -> type[BaseModel]:
+        # schemas are built once on the crud class, only rename them for a custom crud_schema_name
+        if self.crud_schema_name == self.schema.__name__:
+            return schema
+        return create_model(f"{prefix}{self.crud_schema_name}", __base__=schema)
+
     @property
     def id_name_type(self) -> type:
         return self.schema.__fields__[self.crud_model.id_name].type_
@@ -71,8 +132,7 @@ class CRUDRouter(BaseCRUDRouter):
         )
 
     def _create(self):
-        create_schema = create_model(f"Create{self.crud_schema_name}", __base__=self.schema)
-        del create_schema.__fields__[self.crud_model.id_name]
+        create_schema = self.crud_schema(self.crud_model._create_schema, "Create")
 
         async def _create(data: create_schema, crud: BaseCrud = Depends(self.crud_model_dependence)):
             return await crud.create(**data.dict())
@@ -89,10 +149,7 @@ class CRUDRouter(BaseCRUDRouter):
         self.get("/{pk}", response_model=self.schema, responses=RESPONSES)(_read)
 
     def _update_patch(self):
-        patch_schema = create_model(f"PartUpdate{self.crud_schema_name}", __base__=self.schema)
-        del patch_schema.__fields__[self.crud_model.id_name]
-        for k in patch_schema.__fields__:
-            patch_schema.__fields__[k].required = False
+        patch_schema = self.crud_schema(self.crud_model._patch_schema, "PartUpdate")
 
         async def _patch(
             pk: self.id_name_type, data: patch_schema, crud: BaseCrud = Depends(self.crud_model_dependence)
@@ -105,8 +162,7 @@ class CRUDRouter(BaseCRUDRouter):
         self.patch("/{pk}", response_model=self.schema, responses=RESPONSES)(_patch)
 
     def _update_put(self):
-        put_schema = create_model(f"FullUpdate{self.crud_schema_name}", __base__=self.schema)
-        del put_schema.__fields__[self.crud_model.id_name]
+        put_schema = self.crud_schema(self.crud_model._put_schema, "FullUpdate")
 
         async def _put(pk: self.id_name_type, data: put_schema, crud: BaseCrud = Depends(self.crud_model_dependence)):
             resp = await crud.update(pk, **data.dict())
@@ -142,8 +198,10 @@ class BulkCRUDRouter(BaseCRUDRouter):
     ):
         self.only_errors = only_errors
         self.available_filters = crud_model.available_filters
+        self.filter_parameters = crud_filter_parameters(crud_model)
         if available_filters is not None:
             self.available_filters = available_filters
+            self.filter_parameters = filter_parameters(available_filters)
 
         super().__init__(
             crud_model,
@@ -155,91 +213,77 @@ class BulkCRUDRouter(BaseCRUDRouter):
         )
 
     def _bulk_create(self):
-        create_schema = create_model(f"BulkCreate{self.crud_schema_name}", __base__=self.schema)
-        del create_schema.__fields__[self.crud_model.id_name]
+        create_schema = self.crud_schema(self.crud_model._bulk_create_schema, "BulkCreate")
 
         async def _create(data: tuple[create_schema, ...], crud: BaseBulkCrud = Depends(self.crud_model_dependence)):
-            return [
-                resp_obj
-                async for resp_obj in crud.bulk_create([obj.dict() for obj in data], only_errors=self.only_errors)
-            ]
+            return await ndjson_response(crud.bulk_create(data, only_errors=self.only_errors), status_code=201)
 
         if self.only_errors:
-            response_model = list[ErrorModel]
+            response_model = ErrorModel
         else:
-            response_model = list[self.schema | ErrorModel]
-        self.post("", response_model=response_model, status_code=201)(_create)
+            response_model = self.schema | ErrorModel
+        self.post("", **ndjson_route(response_model, status_code=201))(_create)
 
     def _bulk_update(self):
-        patch_schema = create_model(f"BulkPartUpdate{self.crud_schema_name}", __base__=self.schema)
-        for k in patch_schema.__fields__:
-            patch_schema.__fields__[k].required = False
+        patch_schema = self.crud_schema(self.crud_model._bulk_update_schema, "BulkPartUpdate")
 
         async def _patch(data: tuple[patch_schema, ...], crud: BaseBulkCrud = Depends(self.crud_model_dependence)):
-            return [
-                resp_obj
-                async for resp_obj in crud.bulk_update(
-                    [obj.dict(exclude_unset=True) for obj in data], only_errors=self.only_errors
-                )
-            ]
+            return await ndjson_response(
+                crud.bulk_update([obj.dict(exclude_unset=True) for obj in data], only_errors=self.only_errors)
+            )
 
         if self.only_errors:
-            response_model = list[ErrorModel]
+            response_model = ErrorModel
         else:
-            response_model = list[self.schema | ErrorModel]
+            response_model = self.schema | ErrorModel
 
-        self.patch("", response_model=response_model)(_patch)
+        self.patch("", **ndjson_route(response_model))(_patch)
 
     def _bulk_delete(self):
-        _schema = create_model(
-            f"BulkDelete{self.crud_schema_name}", **{self.crud_model.id_name: (self.id_name_type, ...)}
-        )
+        _schema = self.crud_schema(self.crud_model._bulk_delete_schema, "BulkDelete")
 
         async def _delete(pks: list[_schema], crud: BaseBulkCrud = Depends(self.crud_model_dependence)):
-            return [
-                resp_obj
-                async for resp_obj in crud.bulk_delete(
-                    [getattr(obj, self.crud_model.id_name) for obj in pks], only_errors=self.only_errors
-                )
-            ]
+            return await ndjson_response(
+                crud.bulk_delete([getattr(obj, self.crud_model.id_name) for obj in pks], only_errors=self.only_errors)
+            )
 
         if self.only_errors:
-            response_model = list[ErrorModel]
+            response_model = ErrorModel
         else:
-            response_model = list[self.schema | ErrorModel]
+            response_model = self.schema | ErrorModel
 
-        self.delete("", response_model=response_model)(_delete)
+        self.delete("", **ndjson_route(response_model))(_delete)
 
     def _read_many(self):
-        response_model = list[self.schema]
-
-        OrderByEnum = enum.Enum(
-            "OrderByEnum",
-            {
-                f"{field.name}_{by}": f"{field.name}_{by}"
-                for field in self.schema.__fields__.values()
-                for by in ByEnum._member_names_
-            },
-        )
+        response_model = self.schema
+
+        # enum value -> (field, direction), parsed once instead of splitting the value per request
+        order_by_fields = {
+            f"{field.name}_{by.value}": (field.name, by) for field in self.schema.__fields__.values() for by in ByEnum
+        }
+        OrderByEnum = enum.Enum("OrderByEnum", {value: value for value in order_by_fields})
 
         async def _get(
             limit: int | None = None,
             offset: int | None = None,
             order_by: list[OrderByEnum] | None = Query(None),
+            crud: BaseBulkCrud = Depends(self.crud_model_dependence),
             **filters,
         ):
-            print(limit, offset, order_by, filters)
-            return []
+            return await ndjson_response(
+                crud.read_many(
+                    limit=limit,
+                    offset=offset,
+                    order_by=None if order_by is None else dict(order_by_fields[o.value] for o in order_by),
+                    **{k: v for k, v in filters.items() if v is not None},
+                )
+            )
 
-        _filter_params = [
-            Parameter(_f, Parameter.KEYWORD_ONLY, default=Query(None), annotation=_t)
-            for _f, _t in self.available_filters.items()
-        ]
         sig = signature(_get)
         params = sig.parameters
         new_sig = sig.replace(
-            parameters=[param for param in params.values() if param.name != "filters"] + _filter_params
+            parameters=[param for param in params.values() if param.name != "filters"] + list(self.filter_parameters)
         )
         _get.__signature__ = new_sig
 
-        self.get("", response_model=response_model)(_get)
+        self.get("", **ndjson_route(response_model))(_get)
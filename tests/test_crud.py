@@ -0,0 +1,307 @@
+import asyncio
+import contextlib
+from collections import defaultdict
+
+import pytest
+from pydantic import BaseModel
+
+from crud_api.asyncpg import AsyncpgBulkCrud
+from crud_api.base import ByEnum
+
+
+class Schema(BaseModel):
+    id: int
+    user_id: str
+    score: int
+
+
+class BulkCrud(AsyncpgBulkCrud):
+    table = "example"
+    schema = Schema
+
+
+class Nested(BaseModel):
+    a: int
+
+
+class NestedSchema(BaseModel):
+    id: int
+    data: Nested
+
+
+class NestedBulkCrud(AsyncpgBulkCrud):
+    table = "nested"
+    schema = NestedSchema
+
+
+class Cursor:
+    async def fetch(self, n):
+        return []
+
+
+def row(**values):
+    return defaultdict(lambda: None, values)
+
+
+class Connection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def run(self, method, sql, args, values):
+        # a round trip, other workers get to run meanwhile
+        await asyncio.sleep(0)
+        if any(isinstance(v, BaseModel) for v in values):
+            raise TypeError("models are not encoded by codecs")
+        if self.pool.bad is not None and self.pool.bad in values:
+            self.pool.failed.append((self, method, args))
+            raise ValueError(f"bad value {self.pool.bad!r}")
+        self.pool.calls.append((self, method, " ".join(sql.split()), args))
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    async def cursor(self, sql, *args):
+        await self.run("cursor", sql, args, args)
+        return Cursor()
+
+    async def fetchrow(self, sql, *args):
+        await self.run("fetchrow", sql, args, args)
+        return row(id=args[0])
+
+    async def fetch(self, sql, *args):
+        await self.run("fetch", sql, args, args)
+        return [row(id=i) for i in range(sql.count("),(") + 1)]
+
+    async def executemany(self, sql, args):
+        await self.run("executemany", sql, args, [v for a in args for v in a])
+
+    async def copy_records_to_table(self, table, records, columns):
+        await self.run("copy", table, records, [v for r in records for v in r])
+
+
+class Pool:
+    def __init__(self, bad=None, max_size=4):
+        self.bad = bad
+        self.max_size = max_size
+        self.calls = []
+        self.failed = []
+        self.acquired = 0
+        self.active = 0
+
+    def get_max_size(self):
+        return self.max_size
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        self.acquired += 1
+        self.active += 1
+        try:
+            yield Connection(self)
+        finally:
+            self.active -= 1
+
+
+def collect(objs) -> list:
+    async def run():
+        return [obj async for obj in objs]
+
+    return asyncio.run(run())
+
+
+def read_many(**kwargs) -> tuple[str, tuple]:
+    crud = BulkCrud(Pool())
+    collect(crud.read_many(**kwargs))
+    ((_, _, sql, args),) = crud.pool.calls
+    return sql, args
+
+
+def test_filter_on_underscored_column():
+    sql, args = read_many(user_id_eq="a")
+    assert sql == "select id,user_id,score from example where user_id = $1"
+    assert args == ("a",)
+
+
+def test_unknown_filter_is_ignored():
+    sql, args = read_many(user_eq="a", score_gte=1)
+    assert sql == "select id,user_id,score from example where score >= $1"
+    assert args == (1,)
+
+
+def test_in_filter_binds_one_array():
+    sql, args = read_many(id_in=(3, 4))
+    assert sql == "select id,user_id,score from example where id = any($1)"
+    assert args == ((3, 4),)
+
+
+def test_order_by_keeps_requested_order():
+    sql, _ = read_many(order_by={"score": ByEnum.desc, "id": ByEnum.asc})
+    assert sql == "select id,user_id,score from example order by score desc,id asc"
+
+
+def test_order_by_goes_between_where_and_limit():
+    sql, args = read_many(limit=10, offset=20, order_by={"id": ByEnum.desc}, score_gt=5)
+    assert sql == "select id,user_id,score from example where score > $1 order by id desc limit $2 offset $3"
+    assert args == (5, 10, 20)
+
+
+def test_bulk_create_retries_failed_batch_row_by_row():
+    crud = BulkCrud(Pool(bad="b"))
+    crud.bulk_batch_size = 2
+    data = [Schema(id=0, user_id=user_id, score=1) for user_id in ("a", "b", "c")]
+
+    errors = collect(crud.bulk_create(data))
+
+    assert [(e.obj["user_id"], e.error) for e in errors] == [("b", "bad value 'b'")]
+    assert [(method, args) for _, method, _, args in crud.pool.calls] == [
+        ("fetchrow", ("a", 1)),
+        ("copy", [("c", 1)]),
+    ]
+    assert crud.pool.acquired == 1
+
+
+def test_bulk_create_returning_retries_failed_batch_row_by_row():
+    crud = BulkCrud(Pool(bad="b"))
+    data = [Schema(id=0, user_id=user_id, score=1) for user_id in ("a", "b", "c")]
+
+    objs = collect(crud.bulk_create(data, only_errors=False))
+
+    assert [type(obj).__name__ for obj in objs] == ["Schema", "ErrorModel", "Schema"]
+    assert [(method, args) for _, method, _, args in crud.pool.calls] == [
+        ("fetchrow", ("a", 1)),
+        ("fetchrow", ("c", 1)),
+    ]
+
+
+def test_fan_out_keeps_repeated_pk_in_order_on_one_connection():
+    crud = BulkCrud(Pool())
+    data = [{"id": 1, "user_id": "a"}, {"id": 2, "user_id": "b"}, {"id": 1, "user_id": "c"}, {"id": 1, "score": 3}]
+
+    collect(crud.bulk_update(data, only_errors=False))
+
+    first = [(conn, args) for conn, _, _, args in crud.pool.calls if args[0] == 1]
+    assert [args for _, args in first] == [(1, "a"), (1, "c"), (1, 3)]
+    assert len({conn for conn, _ in first}) == 1
+    assert crud.pool.acquired == 2
+
+
+def test_fan_out_caps_workers():
+    crud = BulkCrud(Pool())
+    crud.bulk_concurrency = 2
+
+    assert len(collect(crud.bulk_delete(range(10), only_errors=False))) == 10
+    assert crud.pool.acquired == 2
+
+
+def test_fan_out_empty_input_acquires_nothing():
+    crud = BulkCrud(Pool())
+
+    assert collect(crud.bulk_update([], only_errors=False)) == []
+    assert collect(crud.bulk_delete([], only_errors=False)) == []
+    assert crud.pool.acquired == 0
+
+
+def test_fan_out_waits_for_consumer_and_releases_connections_on_early_exit():
+    crud = BulkCrud(Pool())
+
+    async def run():
+        objs = crud.bulk_delete(range(50), only_errors=False)
+        await anext(objs)
+        for _ in range(100):
+            await asyncio.sleep(0)
+        # one result taken, at most one per worker queued and one per worker waiting to be queued
+        assert len(crud.pool.calls) <= 9
+        await objs.aclose()
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert crud.pool.acquired == 4
+    assert crud.pool.active == 0
+
+
+def test_bulk_create_converts_nested_models():
+    crud = NestedBulkCrud(Pool())
+    data = [NestedSchema(id=0, data=Nested(a=1)), NestedSchema(id=0, data=Nested(a=2))]
+
+    assert collect(crud.bulk_create(data)) == []
+    assert [(method, args) for _, method, _, args in crud.pool.calls] == [("copy", [({"a": 1},), ({"a": 2},)])]
+
+
+def test_bulk_create_retries_nested_models_as_dicts():
+    crud = NestedBulkCrud(Pool(bad={"a": 2}))
+    data = [NestedSchema(id=0, data=Nested(a=1)), NestedSchema(id=0, data=Nested(a=2))]
+
+    errors = collect(crud.bulk_create(data))
+
+    assert [e.obj for e in errors] == [{"id": 0, "data": {"a": 2}}]
+    assert [(method, args) for _, method, _, args in crud.pool.calls] == [("fetchrow", ({"a": 1},))]
+
+
+def test_bulk_crud_builds_only_bulk_schemas():
+    assert BulkCrud._bulk_create_schema.__name__ == "BulkCreateSchema"
+    assert not hasattr(BulkCrud, "_create_schema")
+
+
+def test_schema_without_id_name_is_rejected():
+    class NoId(BaseModel):
+        pk: int
+
+    with pytest.raises(ValueError, match="'id'"):
+
+        class Crud(AsyncpgBulkCrud):
+            table = "no_id"
+            schema = NoId
+
+
+def calls(pool, method) -> list:
+    return [args for _, m, _, args in pool.calls if m == method]
+
+
+def test_bulk_update_batches_only_unique_pks_with_the_same_fields():
+    crud = BulkCrud(Pool())
+    data = [
+        {"id": 1, "user_id": "a"},
+        {"id": 2, "user_id": "b"},
+        {"id": 3, "score": 1},
+        {"id": 4, "user_id": "c"},
+        {"id": 4, "user_id": "d"},
+        {"user_id": "e"},
+        {"id": 5},
+    ]
+
+    errors = collect(crud.bulk_update(data))
+
+    assert calls(crud.pool, "executemany") == [[(1, "a"), (2, "b")]]
+    assert sorted(calls(crud.pool, "fetchrow")) == [(3, 1), (4, "c"), (4, "d")]
+    assert [args for args in calls(crud.pool, "fetchrow") if args[0] == 4] == [(4, "c"), (4, "d")]
+    assert sorted((e.error, e.obj) for e in errors) == [
+        ("No fields for update", {"id": 5}),
+        ("id not in object", {"user_id": "e"}),
+    ]
+
+
+def test_bulk_update_retries_failed_batch_row_by_row():
+    crud = BulkCrud(Pool(bad="b"))
+    data = [{"id": 1, "user_id": "a"}, {"id": 2, "user_id": "b"}, {"id": 3, "user_id": "c"}]
+
+    errors = collect(crud.bulk_update(data))
+
+    assert [e.obj for e in errors] == [{"id": 2, "user_id": "b"}]
+    assert [method for _, method, _ in crud.pool.failed] == ["executemany", "fetchrow"]
+    assert sorted(calls(crud.pool, "fetchrow")) == [(1, "a"), (3, "c")]
+
+
+def test_bulk_update_without_retry_takes_one_connection():
+    crud = BulkCrud(Pool())
+
+    assert collect(crud.bulk_update([{"id": 1, "user_id": "a"}, {"id": 2, "user_id": "b"}])) == []
+    assert crud.pool.acquired == 1
+
+
+def test_bulk_delete_retries_failed_executemany_by_pk():
+    crud = BulkCrud(Pool(bad=2))
+
+    errors = collect(crud.bulk_delete([1, 2, 3]))
+
+    assert [e.obj for e in errors] == [{"pk": 2}]
+    assert calls(crud.pool, "executemany") == []
+    assert sorted(calls(crud.pool, "fetchrow")) == [(1,), (3,)]